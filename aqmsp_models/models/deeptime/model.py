@@ -1,15 +1,16 @@
 import os
-
-os.environ["CUDA_VISIBLE_DEVICES"] = "3"
-
 from os.path import join
+from contextlib import nullcontext
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as distributed
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 from astra.torch.models import MLPRegressor, SIRENRegressor
 
@@ -23,165 +24,319 @@ class DeepTime(nn.Module):
         # self.mlp = MLPRegressor(x_dim, hidden_dims, repr_dim, dropout=dropout)
         self.log_noise_var = nn.Parameter(torch.tensor(np.log(0.01)))
 
-    def forward(self, x_context, y_context, x_target):
-        mean = y_context.mean(dim=1, keepdim=True)  # over datapoints dim
-        std = y_context.std(dim=1, keepdim=True)  # over datapoints dim
-        y_context = (y_context - mean) / std
-
-        def single_dim_calc(x_context, y_context, x_target):
-            context_repr = self.mlp(x_context)
-            target_repr = self.mlp(x_target)
+    def forward(self, x_context, y_context, x_target, context_mask=None):
+        if context_mask is None:
+            context_mask = torch.ones_like(y_context, dtype=torch.bool)
+
+        num_context = context_mask.sum(dim=1, keepdim=True)
+        mean = torch.where(context_mask, y_context, 0.0).sum(dim=1, keepdim=True) / num_context  # over datapoints dim
+        std = torch.sqrt(
+            torch.where(context_mask, (y_context - mean) ** 2, 0.0).sum(dim=1, keepdim=True) / (num_context - 1)
+        )  # over datapoints dim
+        y_context = torch.where(context_mask, (y_context - mean) / std, 0.0)
+
+        b, n_context, x_dim = x_context.shape
+        n_target = x_target.shape[1]
+        context_repr = self.mlp(x_context.reshape(-1, x_dim)).reshape(b, n_context, -1)
+        target_repr = self.mlp(x_target.reshape(-1, x_dim)).reshape(b, n_target, -1)
+
+        # add bias term
+        context_repr = F.pad(context_repr, (0, 1), value=1.0)
+        target_repr = F.pad(target_repr, (0, 1), value=1.0)
+
+        # padded context points must not contribute to the normal equations
+        context_repr = torch.where(context_mask, context_repr, 0.0)
+
+        # the normal equations and solve run in float64 (outside autocast, and never TF32) as the Cholesky is
+        # sensitive to small eigenvalues
+        with torch.autocast(x_context.device.type, enabled=False):
+            context_repr = context_repr.double()
+            cov = context_repr.mT @ context_repr
+            xty = context_repr.mT @ y_context.double()
+            cov.diagonal(dim1=-2, dim2=-1).add_(torch.exp(self.log_noise_var.double()))
 
-            # add bias term
-            context_repr = torch.cat(
-                [context_repr, torch.ones(context_repr.shape[0], 1, device=x_context.device)], dim=1
-            )
-            target_repr = torch.cat([target_repr, torch.ones(target_repr.shape[0], 1, device=x_context.device)], dim=1)
+            chol = torch.linalg.cholesky(cov)
+            z = torch.linalg.solve_triangular(chol, xty, upper=False)
+            w = torch.linalg.solve_triangular(chol.mT, z, upper=True)
+        y_pred = (target_repr @ w.to(target_repr.dtype)).float()
 
-            cov = context_repr.T @ context_repr
-            cov.diagonal().add_(torch.exp(self.log_noise_var))
-            xty = context_repr.T @ y_context
+        return y_pred * std + mean
 
-            chol = torch.linalg.cholesky(cov)
-            w = torch.cholesky_solve(xty, chol)
-            y_pred = target_repr @ w
-            return y_pred
 
-        y_pred = torch.vmap(single_dim_calc, in_dims=(0, 0, 0), out_dims=0, randomness="same")(
-            x_context, y_context, x_target
-        )
+class CUDAPrefetcher:
+    # copies the next batch to the device on a side stream while the current batch is being trained on
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        batches = iter(self.dataloader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in next_batch:
+                    tensor.record_stream(current_stream)
+            batch = next_batch
+            next_batch = self.preload(batches)
+            yield batch
+
+    def preload(self, batches):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            return tuple(tensor.to(self.device, non_blocking=True) for tensor in batch)
+
+
+def group_by_time(df, config):
+    groups = {}
+    for t, ts_df in df.groupby("time", sort=False):
+        X = ts_df[config.features].to_numpy(dtype=np.float32)
+        y = ts_df[[config.target]].to_numpy(dtype=np.float32)
+        groups[t] = (X, y)
+    return groups
+
+
+def save_groups(groups, path):
+    # one flat array per quantity plus offsets so that `load_groups` can memory-map them
+    os.makedirs(path, exist_ok=True)
+    Xs, ys = zip(*groups.values())
+    np.save(join(path, "times.npy"), np.array(list(groups), dtype="datetime64[ns]"))
+    np.save(join(path, "X.npy"), np.concatenate(Xs))
+    np.save(join(path, "y.npy"), np.concatenate(ys))
+    np.save(join(path, "offsets.npy"), np.cumsum([0] + [len(X) for X in Xs]))
+
+
+def load_groups(path):
+    times = np.load(join(path, "times.npy"))
+    X = np.load(join(path, "X.npy"), mmap_mode="c")
+    y = np.load(join(path, "y.npy"), mmap_mode="c")
+    offsets = np.load(join(path, "offsets.npy"))
+    return {pd.Timestamp(t): (X[start:end], y[start:end]) for t, start, end in zip(times, offsets[:-1], offsets[1:])}
+
+
+def load_train_groups(train_data, fet_min, fet_max, config):
+    # reuse the arrays cached by `fit` if they cover the same timestamps and rows, otherwise rebuild them
+    path = join(config.working_dir, "train_groups")
+    if os.path.exists(join(path, "offsets.npy")):
+        groups = load_groups(path)
+        num_rows = sum(len(X) for X, _ in groups.values())
+        if list(groups) == list(pd.to_datetime(train_data.time.values)) and num_rows == train_data[config.target].size:
+            return groups
 
-        return y_pred * std + mean
+    train_df = train_data.to_dataframe().reset_index()
+    X = train_df[config.features].to_numpy(dtype=np.float32)
+    train_df[config.features] = (X - fet_min) / (fet_max - fet_min)
+    return group_by_time(train_df, config)
 
 
 def fit(train_data, config):
     torch.manual_seed(config.random_state)
+    torch.backends.cuda.matmul.allow_tf32 = config.allow_tf32
+    torch.backends.cudnn.allow_tf32 = config.allow_tf32
+
+    # data-parallel training across GPUs when launched with torchrun
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    is_main = int(os.environ.get("RANK", "0")) == 0
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    if world_size > 1:
+        distributed.init_process_group("nccl")
+        torch.cuda.set_device(local_rank)
 
     train_df = train_data.to_dataframe().reset_index()
 
-    meta_dict = {}
-    for feature in config.features:
-        fet_min = train_data[feature].min().item()
-        fet_max = train_data[feature].max().item()
+    fet_min = np.array([train_data[feature].min().item() for feature in config.features], dtype=np.float32)
+    fet_max = np.array([train_data[feature].max().item() for feature in config.features], dtype=np.float32)
+    meta_dict = {"features_min": torch.from_numpy(fet_min), "features_max": torch.from_numpy(fet_max)}
 
-        meta_dict.update(
-            {
-                f"{feature}_min": fet_min,
-                f"{feature}_max": fet_max,
-            }
-        )
+    X = train_df[config.features].to_numpy(dtype=np.float32)
+    train_df[config.features] = (X - fet_min) / (fet_max - fet_min)
 
-        train_df[feature] = (train_df[feature] - fet_min) / (fet_max - fet_min)
+    # cache the scaled per-timestamp arrays so that `predict` does not redo this work
+    train_groups = group_by_time(train_df, config)
+    if is_main:
+        save_groups(train_groups, join(config.working_dir, "train_groups"))
 
     class CustomDataset(Dataset):
-        def __init__(self, df):
-            self.df = df
-            self.ts = self.df.time.unique()
+        def __init__(self, groups):
+            self.groups = {}
+            for t, (X, y) in groups.items():
+                valid = ~np.isnan(y[:, 0])
+                if valid.any():
+                    self.groups[t] = (X[valid], y[valid])
+            self.ts = list(self.groups)
+
+            # pad every sample to the largest context/target set so that batch shapes are static
+            sizes = [len(X) for X, _ in self.groups.values()]
+            self.max_context = max(int(config.context_fraction * n) for n in sizes)
+            self.max_target = max(n - int(config.context_fraction * n) for n in sizes)
 
         def __len__(self):
             return len(self.ts)
 
         def __getitem__(self, idx):
-            t = self.ts[idx]
-            ts_df = self.df[self.df.time == t]
-            ts_df = ts_df.dropna(subset=[config.target])
-            X = torch.tensor(ts_df[config.features].values, dtype=torch.float32)
-            y = torch.tensor(ts_df[[config.target]].values, dtype=torch.float32)
-            idx = np.random.permutation(len(X))
+            X, y = self.groups[self.ts[idx]]
+            X, y = torch.from_numpy(X), torch.from_numpy(y)
+            perm = torch.randperm(len(X))
             num_context = int(config.context_fraction * len(X))
-            X_context = X[idx[:num_context]]
-            y_context = y[idx[:num_context]]
-            X_target = X[idx[num_context:]]
-            y_target = y[idx[num_context:]]
+            context_idx, target_idx = perm[:num_context], perm[num_context:]
+            X_context, y_context = X.index_select(0, context_idx), y.index_select(0, context_idx)
+            X_target, y_target = X.index_select(0, target_idx), y.index_select(0, target_idx)
             return X_context, y_context, X_target, y_target
 
-    dataset = CustomDataset(train_df)
-    dataloader = DataLoader(dataset, batch_size=config.batch_size, shuffle=True)
+    dataset = CustomDataset(train_groups)
+
+    def collate(batch):
+        def pad(tensors, size):
+            out = torch.zeros(len(tensors), size, tensors[0].shape[-1])
+            mask = torch.zeros(len(tensors), size, 1, dtype=torch.bool)
+            for i, tensor in enumerate(tensors):
+                out[i, : len(tensor)] = tensor
+                mask[i, : len(tensor)] = True
+            return out, mask
+
+        X_context, y_context, X_target, y_target = zip(*batch)
+        X_context, context_mask = pad(X_context, dataset.max_context)
+        y_context, _ = pad(y_context, dataset.max_context)
+        X_target, target_mask = pad(X_target, dataset.max_target)
+        y_target, _ = pad(y_target, dataset.max_target)
+        return X_context, y_context, context_mask, X_target, y_target, target_mask
+
+    sampler = DistributedSampler(dataset) if world_size > 1 else None
+    num_workers = min(config.num_workers, os.cpu_count())
+    dataloader = DataLoader(
+        dataset,
+        batch_size=config.batch_size,
+        shuffle=sampler is None,
+        sampler=sampler,
+        collate_fn=collate,
+        num_workers=num_workers,
+        pin_memory=config.pin_memory,
+        persistent_workers=num_workers > 0,
+    )
 
     cnp = DeepTime(len(config.features), 1, config.hidden_dims, config.repr_dim, config.dropout).to(config.device)
-    optimizer = torch.optim.Adam(cnp.parameters(), lr=config.lr)
+    if config.compile_model:
+        cnp.compile(mode="reduce-overhead", dynamic=False)  # in-place, so state_dict keys are unchanged
+    # `model` syncs gradients across ranks, `cnp` is kept for saving un-prefixed state_dict keys
+    model = DDP(cnp, device_ids=[local_rank]) if world_size > 1 else cnp
+    # the fused and capturable (CUDA graph friendly) Adam kernels are CUDA only
+    device_type = torch.device(config.device).type
+    use_fused = device_type == "cuda"
+    optimizer = torch.optim.Adam(cnp.parameters(), lr=config.lr, fused=use_fused, capturable=use_fused)
+
+    # bfloat16 needs no loss scaling, float16 does
+    amp_dtype = getattr(torch, config.amp_dtype)
+    scaler = torch.amp.GradScaler(device_type, enabled=amp_dtype == torch.float16)
+
+    prefetcher = CUDAPrefetcher(dataloader, config.device)
 
     losses = []
     best_loss = np.inf
     for epoch in range(config.epochs):
-        epoch_loss = 0
-        for X_context, y_context, X_target, y_target in tqdm(dataloader):
-            X_context = X_context.to(config.device)
-            y_context = y_context.to(config.device)
-            X_target = X_target.to(config.device)
-            y_target = y_target.to(config.device)
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        epoch_loss = torch.zeros((), device=config.device)  # summed on device to avoid a sync per step
+        for X_context, y_context, context_mask, X_target, y_target, target_mask in tqdm(prefetcher):
+            with torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype != torch.float32):
+                y_pred = model(X_context, y_context, X_target, context_mask)
+            loss = torch.where(target_mask, (y_pred - y_target) ** 2, 0.0).sum() / target_mask.sum()
+            epoch_loss += loss.detach()
+
+            optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+        if world_size > 1:
+            distributed.all_reduce(epoch_loss)
+            epoch_loss /= world_size
+        losses.append(epoch_loss.item() / len(dataloader))
 
-            y_pred = cnp(X_context, y_context, X_target)
-            loss = F.mse_loss(y_pred, y_target)
-            epoch_loss += loss.item()
+        if losses[-1] < best_loss:
+            best_loss = losses[-1]
+            if is_main:
+                torch.save(cnp.state_dict(), join(config.working_dir, "model.pt"))
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+        if is_main:
+            print(f"Epoch {epoch + 1}/{config.epochs}, Loss: {losses[-1]:.4f}")
 
-        losses.append(epoch_loss / len(dataloader))
+    if is_main:
+        meta_dict["losses"] = losses
+        torch.save(
+            meta_dict,
+            join(config.working_dir, "metadata.pt"),
+        )
 
-        if losses[-1] < best_loss:
-            best_loss = losses[-1]
-            torch.save(cnp.state_dict(), join(config.working_dir, "model.pt"))
+    if world_size > 1:
+        distributed.destroy_process_group()
 
-        print(f"Epoch {epoch + 1}/{config.epochs}, Loss: {losses[-1]:.4f}")
+    return train_groups
 
-    meta_dict["losses"] = losses
-    torch.save(
-        meta_dict,
-        join(config.working_dir, "metadata.pt"),
-    )
 
+def predict(test_data, train_data, config, train_groups=None):
+    torch.backends.cuda.matmul.allow_tf32 = config.allow_tf32
+    torch.backends.cudnn.allow_tf32 = config.allow_tf32
 
-def predict(test_data, train_data, config):
     # load meta
-    meta = torch.load(join(config.working_dir, "metadata.pt"))
+    meta = torch.load(join(config.working_dir, "metadata.pt"), map_location="cpu", weights_only=True)
 
-    # prepare test data
-    train_df = train_data.to_dataframe().reset_index()
+    # prepare data, the scaled train data is usually cached by `fit`
+    fet_min, fet_max = meta["features_min"].numpy(), meta["features_max"].numpy()
+    if train_groups is None:
+        train_groups = load_train_groups(train_data, fet_min, fet_max, config)
     test_df = test_data.to_dataframe().reset_index()
-    for feature in config.features:
-        fet_min = meta[f"{feature}_min"]
-        fet_max = meta[f"{feature}_max"]
-        train_df[feature] = (train_df[feature] - fet_min) / (fet_max - fet_min)
-        test_df[feature] = (test_df[feature] - fet_min) / (fet_max - fet_min)
+    X = test_df[config.features].to_numpy(dtype=np.float32)
+    test_df[config.features] = (X - fet_min) / (fet_max - fet_min)
 
     class CustomDataset(Dataset):
-        def __init__(self, train_df, test_df):
-            self.train_df = train_df
-            self.test_df = test_df
-            self.ts = self.train_df.time.unique()
+        def __init__(self, train_groups, test_df):
+            self.train_groups = train_groups
+            self.test_groups = group_by_time(test_df, config)
+            self.ts = list(self.train_groups)
 
         def __len__(self):
             return len(self.ts)
 
         def __getitem__(self, idx):
             t = self.ts[idx]
-            train_df = self.train_df[self.train_df.time == t]
-            test_df = self.test_df[self.test_df.time == t]
-            train_X = torch.tensor(train_df[config.features].values, dtype=torch.float32)
-            test_X = torch.tensor(test_df[config.features].values, dtype=torch.float32)
-            train_y = torch.tensor(train_df[[config.target]].values, dtype=torch.float32)
-            test_y = torch.tensor(test_df[[config.target]].values, dtype=torch.float32)
+            train_X, train_y = self.train_groups[t]
+            test_X, test_y = self.test_groups[t]
+            train_X, train_y = torch.from_numpy(train_X), torch.from_numpy(train_y)
+            test_X, test_y = torch.from_numpy(test_X), torch.from_numpy(test_y)
             return train_X, train_y, test_X, test_y
 
     # dataset
-    dataset = CustomDataset(train_df, test_df)
-    dataloader = DataLoader(dataset, batch_size=config.batch_size, shuffle=False)
+    dataset = CustomDataset(train_groups, test_df)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=config.batch_size,
+        shuffle=False,
+        num_workers=min(config.num_workers, os.cpu_count()),
+        pin_memory=config.pin_memory,
+    )
 
     # load model
     cnp = DeepTime(len(config.features), 1, config.hidden_dims, config.repr_dim, config.dropout).to(config.device)
-    cnp.load_state_dict(torch.load(join(config.working_dir, "model.pt")))
+    cnp.load_state_dict(torch.load(join(config.working_dir, "model.pt"), map_location=config.device, weights_only=True))
     cnp.eval()
+    if config.compile_model:
+        cnp.compile(mode="reduce-overhead", dynamic=False)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         y_pred = []
         for train_X, train_y, test_X, test_y in tqdm(dataloader):
-            train_X = train_X.to(config.device)
-            train_y = train_y.to(config.device)
-            test_X = test_X.to(config.device)
-            test_y = test_y.to(config.device)
+            train_X = train_X.to(config.device, non_blocking=True)
+            train_y = train_y.to(config.device, non_blocking=True)
+            test_X = test_X.to(config.device, non_blocking=True)
+            test_y = test_y.to(config.device, non_blocking=True)
 
             pred_y = cnp(train_X, train_y, test_X)
             y_pred.append(pred_y.cpu().numpy())
@@ -194,5 +349,7 @@ def predict(test_data, train_data, config):
 
 
 def fit_predict(train_data, test_data, config):
-    fit(train_data, config)
-    predict(test_data, train_data, config)
+    # hand the in-memory train groups to `predict` rather than converting or reloading train_data
+    train_groups = fit(train_data, config)
+    if int(os.environ.get("RANK", "0")) == 0:
+        predict(test_data, train_data, config, train_groups)
@@ -5,6 +5,44 @@ from joblib import Parallel, delayed
 from sklearn.ensemble import RandomForestRegressor
 
 
+def get_model(config):
+    if config.backend == "sklearn":
+        return RandomForestRegressor(
+            n_estimators=config.n_estimators,
+            n_jobs=1,
+            random_state=config.random_state,
+            max_depth=config.max_depth,
+        )
+    elif config.backend == "lightgbm":
+        from lightgbm import LGBMRegressor
+
+        return LGBMRegressor(
+            boosting_type="rf",
+            n_estimators=config.n_estimators,
+            max_depth=config.max_depth,
+            subsample=0.8,
+            subsample_freq=1,
+            colsample_bytree=0.8,
+            min_child_samples=1,  # match sklearn's min_samples_leaf, stations per timestamp are few
+            n_jobs=1,
+            random_state=config.random_state,
+            verbose=-1,
+        )
+    elif config.backend == "cuml":
+        from cuml.ensemble import RandomForestRegressor as CuMLRandomForestRegressor
+
+        return CuMLRandomForestRegressor(
+            n_estimators=config.n_estimators,
+            max_depth=config.max_depth,
+            n_streams=1,
+            random_state=config.random_state,
+        )
+    else:
+        raise ValueError(
+            f"Unknown backend '{config.backend}' for 'rf' model. Choose from 'sklearn', 'lightgbm' or 'cuml'."
+        )
+
+
 def fit(train_data, config):
     raise NotImplementedError(
         "'fit' mode is not implemented for 'rf' model. Please use 'fit_predict' mode instead."
@@ -18,26 +56,35 @@ def predict(test_data, train_data, config):
 
 
 def fit_predict(train_data, test_data, config):
-    def train_fn(ts):
-        train_df = train_data.sel(time=ts).to_dataframe()
-        train_df = train_df[train_df[f"{config.target}_missing"] == False]
+    # convert and split by time once, instead of a `.sel(time=ts).to_dataframe()` per timestamp
+    train_df = train_data.to_dataframe().reset_index()
+    train_df = train_df[train_df[f"{config.target}_missing"] == False]
+    test_df = test_data.to_dataframe().reset_index()
 
-        test_X = test_data.sel(time=ts).to_dataframe().reset_index()[config.features]
+    train_groups = {
+        t: (df[config.features].to_numpy(dtype=np.float32), df[config.target].to_numpy())
+        for t, df in train_df.groupby("time")
+    }
+    test_groups = {t: df[config.features].to_numpy(dtype=np.float32) for t, df in test_df.groupby("time")}
+    empty = (np.empty((0, len(config.features)), dtype=np.float32), np.empty(0))
 
-        model = RandomForestRegressor(
-            n_estimators=config.n_estimators,
-            n_jobs=1,
-            random_state=config.random_state,
-            max_depth=config.max_depth,
-        )
+    prepped = []
+    for ts in train_data.time.values:
+        t = pd.Timestamp(ts)
+        prepped.append((*train_groups.get(t, empty), test_groups[t]))
+
+    def train_fn(train_X, train_y, test_X):
+        model = get_model(config)
         try:
-            model.fit(train_df[config.features], train_df[config.target])
+            model.fit(train_X, train_y)
         except ValueError:
             return np.zeros(len(test_X)) * np.nan
         pred_y = model.predict(test_X)
         return pred_y
 
-    pred_y_list = Parallel(n_jobs=48)(delayed(train_fn)(ts) for ts in tqdm(train_data.time.values))
+    # cuML runs on the GPU and shares one CUDA context across threads instead of one per process
+    prefer = "threads" if config.backend == "cuml" else None
+    pred_y_list = Parallel(n_jobs=48, prefer=prefer)(delayed(train_fn)(*arrays) for arrays in tqdm(prepped))
     pred_y = np.array(pred_y_list)
     test_data[f"{config.target}_pred"] = (("time", "station"), pred_y)
     save_path = f"{config.working_dir}/predictions.nc"
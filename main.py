@@ -27,7 +27,8 @@ parser.add_argument(
 parser.add_argument("--gpu", type=int, required=False, help="Physical GPU ID")
 # take mode argument for train, test. Provide choices
 config = parser.parse_args()
-os.environ["CUDA_VISIBLE_DEVICES"] = str(config.gpu)
+if config.gpu is not None:
+    os.environ["CUDA_VISIBLE_DEVICES"] = str(config.gpu)
 
 # load configs
 common_config = toml.load(f"aqmsp_models/{config.common_config}.toml")